@@ -5,18 +5,51 @@
 
 import yfinance as yf
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
+import aiohttp
+from aiolimiter import AsyncLimiter
 import os
 import time
-import math
-import json
-from io import StringIO
+import orjson
+import sqlite3
+import csv
+import hashlib
 
 # ============== 配置区域 ==============
 NOTION_API_KEY = os.environ.get("NOTION_API_KEY")
 FRED_API_KEY = os.environ.get("FRED_API_KEY")  # 可选
 DATABASE_ID = "1131248983354d15aec2933c5210bbdc"
+NOTION_CONCURRENCY = 3  # Notion API 限速约为每秒3个请求
+CACHE_DB = "market_cache.db"  # Yahoo Finance 收盘价本地缓存
+ADJUST_TOLERANCE = 1e-4  # 缓存价与新下载价的相对差超过此值，视为历史已被复权改写
+STATE_DIR = ".cache"
+LAST_WRITTEN_FILE = os.path.join(STATE_DIR, "last_written.json")  # 各页面上次写入内容的哈希
+NOTION_PAGES_FILE = os.path.join(STATE_DIR, "notion_pages.json")  # 资产名称 -> page_id
+NOTION_PAGES_TTL = 7 * 24 * 3600  # 秒，需大于运行间隔 (工作日每天一次，周末间隔72小时)
+NOTION_MISSING_TTL = 24 * 3600  # 秒，数据库中缺少的资产超过此时间后重新查询，以发现新增的行
+TODAY_STR = datetime.now().strftime("%Y-%m-%d")  # 本次运行的日期，写入"更新时间"
+TODAY_DATE_PROP = {"date": {"start": TODAY_STR}}
+
+# 结果表的列 (每行一个资产)
+RESULT_COLUMNS = ["收盘价", "1天", "1星期", "1个月", "1年", "3年", "5年", "QTD", "YTD"]
+
+# 同步到Notion的数值字段
+NOTION_FIELDS = ("收盘价", "1天", "1星期", "1个月", "1年", "QTD", "YTD")
+
+# 收益率周期 - (字段名, 回看的交易日数+1)
+RETURN_PERIODS = (
+    ("1天", 2),
+    ("1星期", 6),
+    ("1个月", 22),
+    ("1年", 253),
+    ("3年", 756),
+    ("5年", 1260),
+)
 
 # 资产代码映射 - Yahoo Finance
 TICKER_MAP = {
@@ -58,17 +91,62 @@ HEADERS = {
     'Connection': 'keep-alive',
 }
 
+NOTION_HEADERS = {
+    "Authorization": f"Bearer {NOTION_API_KEY}",
+    "Notion-Version": "2022-06-28",
+    "Content-Type": "application/json"
+}
+
+# 共享连接池 (FRED / CBOE / Notion查询)，429/502/503 自动退避重试
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503],
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    ),
+))
+
 def safe_float(value):
     """确保浮点数是JSON兼容的"""
     if value is None:
         return None
-    if isinstance(value, (int, float)):
-        if math.isnan(value) or math.isinf(value):
-            return None
-        return round(float(value), 6)
+    value = float(value)
+    return round(value, 6) if np.isfinite(value) else None
+
+def parse_date(text):
+    """解析 YYYY-MM-DD 或 M/D/YYYY 格式的日期，失败返回None"""
+    for fmt in ("%Y-%m-%d", "%m/%d/%Y"):
+        try:
+            return np.datetime64(datetime.strptime(text.strip(), fmt).date())
+        except ValueError:
+            continue
     return None
 
-def get_fred_data(series_id, api_key=None):
+def parse_float(text):
+    """解析数值，缺失值 ('.'、空串等) 返回NaN"""
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+def decode_csv(response):
+    """按UTF-8解码CSV响应 (requests 默认按响应头推断编码，text/* 未声明charset时为ISO-8859-1)"""
+    return response.content.decode("utf-8", errors="replace")
+
+def build_series(pairs):
+    """(日期, 数值) 列表 -> 按日期排序、去掉缺失值的 (dates, values) 数组"""
+    pairs = sorted((d, v) for d, v in pairs if d is not None and not np.isnan(v))
+    if not pairs:
+        return None
+    dates, values = zip(*pairs)
+    return np.array(dates, dtype='datetime64[D]'), np.array(values, dtype=float)
+
+def get_fred_data(series_id, api_key=None, log=print):
     """从FRED获取数据（垃圾债券利差等）"""
     try:
         # 方法1: 使用FRED API
@@ -81,38 +159,35 @@ def get_fred_data(series_id, api_key=None):
                 "sort_order": "desc",
                 "limit": 365
             }
-            response = requests.get(url, params=params, timeout=30)
+            response = _SESSION.get(url, params=params, timeout=30)
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 observations = data.get("observations", [])
                 if observations:
-                    df = pd.DataFrame(observations)
-                    df['date'] = pd.to_datetime(df['date'])
-                    df['value'] = pd.to_numeric(df['value'], errors='coerce')
-                    df = df.set_index('date').sort_index()
-                    return df['value'].dropna()
+                    return build_series(
+                        (parse_date(obs["date"]), parse_float(obs["value"]))
+                        for obs in observations
+                    )
 
         # 方法2: 直接从FRED网站下载CSV
         url = f"https://fred.stlouisfed.org/graph/fredgraph.csv?id={series_id}"
-        response = requests.get(url, headers=HEADERS, timeout=30)
+        response = _SESSION.get(url, headers=HEADERS, timeout=30)
 
         if response.status_code == 200:
-            df = pd.read_csv(StringIO(response.text))
-            date_col = df.columns[0]
-            value_col = df.columns[1]
-            df[date_col] = pd.to_datetime(df[date_col])
-            df[value_col] = pd.to_numeric(df[value_col], errors='coerce')
-            df = df.set_index(date_col).sort_index()
-            return df[value_col].dropna()
+            rows = list(csv.reader(decode_csv(response).splitlines()))
+            return build_series(
+                (parse_date(row[0]), parse_float(row[1]))
+                for row in rows[1:] if len(row) >= 2
+            )
         else:
-            print(f"  FRED HTTP错误: {response.status_code}")
+            log(f"  FRED HTTP错误: {response.status_code}")
             return None
 
     except Exception as e:
-        print(f"  FRED数据获取失败 ({series_id}): {e}")
+        log(f"  FRED数据获取失败 ({series_id}): {e}")
         return None
 
-def get_cboe_put_call_ratio():
+def get_cboe_put_call_ratio(log=print):
     """从多个备用源获取Put/Call Ratio"""
 
     urls_to_try = [
@@ -124,13 +199,13 @@ def get_cboe_put_call_ratio():
 
     for url, name in urls_to_try:
         try:
-            print(f"  尝试: {name}...")
-            response = requests.get(url, headers=HEADERS, timeout=30)
+            log(f"  尝试: {name}...")
+            response = _SESSION.get(url, headers=HEADERS, timeout=30)
 
             if response.status_code == 200:
-                print(f"  ✓ {name} 成功! (HTTP 200)")
-                content = response.text
-                lines = content.strip().split('\n')
+                log(f"  ✓ {name} 成功! (HTTP 200)")
+                content = decode_csv(response)
+                lines = content.strip().splitlines()
                 data_start = 0
                 for i, line in enumerate(lines):
                     if line.strip() and not line.startswith('Your use') and ',' in line:
@@ -142,156 +217,286 @@ def get_cboe_put_call_ratio():
                             data_start = i
                             break
 
-                clean_content = '\n'.join(lines[data_start:])
-                df = pd.read_csv(StringIO(clean_content))
-                date_col = df.columns[0]
-                df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-                df = df.dropna(subset=[date_col])
-                df = df.set_index(date_col).sort_index()
+                rows = list(csv.reader(lines[data_start:]))
+                if not rows:
+                    continue
+                header = rows[0]
+                if parse_date(header[0]) is not None:
+                    header = []
+                else:
+                    rows = rows[1:]
 
-                ratio_col = None
-                for col in df.columns:
+                ratio_idx = None
+                for i, col in enumerate(header[1:], start=1):
                     col_upper = col.upper()
                     if 'P/C' in col_upper or 'RATIO' in col_upper or 'TOTAL' in col_upper:
-                        ratio_col = col
+                        ratio_idx = i
                         break
-                if ratio_col is None:
-                    ratio_col = df.columns[-1]
 
-                series = pd.to_numeric(df[ratio_col], errors='coerce').dropna()
-                if len(series) > 0:
-                    print(f"  ✓ 解析成功，最新值: {series.iloc[-1]:.2f}")
+                series = build_series(
+                    (parse_date(row[0]), parse_float(row[-1] if ratio_idx is None else row[ratio_idx]))
+                    for row in rows if len(row) >= 2 and (ratio_idx is None or len(row) > ratio_idx)
+                )
+                if series is not None:
+                    log(f"  ✓ 解析成功，最新值: {series[1][-1]:.2f}")
                     return series
             else:
-                print(f"  ✗ {name} 失败: HTTP {response.status_code}")
+                log(f"  ✗ {name} 失败: HTTP {response.status_code}")
 
         except Exception as e:
-            print(f"  ✗ {name} 错误: {e}")
+            log(f"  ✗ {name} 错误: {e}")
 
-    print("  所有CBOE数据源都无法访问")
+    log("  所有CBOE数据源都无法访问")
     return None
 
-def calculate_returns(df, ticker=None):
-    """计算各时间周期的收益率"""
-    if df is None or (hasattr(df, 'empty') and df.empty):
-        return None
+def calculate_all_returns(close_df):
+    """一次性计算所有代码各时间周期的收益率 (行: 日期, 列: 代码) -> (行: 代码, 列: 周期)"""
+    if close_df is None or close_df.empty:
+        return pd.DataFrame(columns=RESULT_COLUMNS, dtype=float)
 
     try:
-        if isinstance(df, pd.DataFrame):
-            if isinstance(df.columns, pd.MultiIndex):
-                close = df[('Close', ticker)] if ticker and ('Close', ticker) in df.columns else df['Close']
-            else:
-                close = df['Close'] if 'Close' in df.columns else df.iloc[:, 0]
-        else:
-            close = df
-
-        close = close.dropna()
-        if len(close) < 2:
-            return None
-
-        today = close.index[-1]
-        close_price = float(close.iloc[-1])
-
-        returns = {"收盘价": safe_float(close_price)}
-
-        if len(close) >= 2:
-            returns["1天"] = safe_float(close.iloc[-1] / close.iloc[-2] - 1)
-
-        if len(close) >= 6:
-            returns["1星期"] = safe_float(close.iloc[-1] / close.iloc[-6] - 1)
-
-        if len(close) >= 22:
-            returns["1个月"] = safe_float(close.iloc[-1] / close.iloc[-22] - 1)
-
-        if len(close) >= 253:
-            returns["1年"] = safe_float(close.iloc[-1] / close.iloc[-253] - 1)
-
-        if len(close) >= 756:
-            returns["3年"] = safe_float(close.iloc[-1] / close.iloc[-756] - 1)
-
-        if len(close) >= 1260:
-            returns["5年"] = safe_float(close.iloc[-1] / close.iloc[-1260] - 1)
-
-        quarter_month = ((today.month - 1) // 3) * 3 + 1
-        quarter_start = pd.Timestamp(datetime(today.year, quarter_month, 1))
-        qtd_data = close[close.index >= quarter_start]
-        if len(qtd_data) >= 2:
-            returns["QTD"] = safe_float(qtd_data.iloc[-1] / qtd_data.iloc[0] - 1)
-
-        year_start = pd.Timestamp(datetime(today.year, 1, 1))
-        ytd_data = close[close.index >= year_start]
-        if len(ytd_data) >= 2:
-            returns["YTD"] = safe_float(ytd_data.iloc[-1] / ytd_data.iloc[0] - 1)
-
-        return returns
+        vals = close_df.to_numpy(dtype=float)
+        dates = close_df.index.values.astype('datetime64[D]')
+        valid = ~np.isnan(vals)
+        counts = valid.sum(axis=0)
+        cols = np.arange(vals.shape[1])
+
+        # 把每列的有效值压到底部，packed[-n] 即该代码倒数第n个交易日
+        order = np.argsort(valid, axis=0, kind='stable')
+        packed = np.take_along_axis(vals, order, axis=0)
+        last = packed[-1]
+
+        # 字段 -> (数值, 是否有足够数据)
+        metrics = {"收盘价": (last, counts >= 1)}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for field, lag in RETURN_PERIODS:
+                if lag <= len(packed):
+                    metrics[field] = (last / packed[-lag] - 1, counts >= lag)
+
+            # 每个代码按自己最后交易日所在的季度/年份计算QTD、YTD
+            last_idx = len(vals) - 1 - np.argmax(valid[::-1], axis=0)
+            last_dates = dates[last_idx]
+            years = last_dates.astype('datetime64[Y]')
+            month_of_year = (last_dates.astype('datetime64[M]') - years.astype('datetime64[M]')).astype(int)
+            quarter_start = (years.astype('datetime64[M]') + (month_of_year // 3) * 3).astype('datetime64[D]')
+            year_start = years.astype('datetime64[D]')
+
+            # 日期已排序：searchsorted 找到起始行，再由累计有效数换算为 packed 中的位置
+            valid_before = np.vstack([np.zeros((1, vals.shape[1]), dtype=int), np.cumsum(valid, axis=0)])
+            for field, start in (("QTD", quarter_start), ("YTD", year_start)):
+                n_since = counts - valid_before[np.searchsorted(dates, start), cols]
+                first_val = packed[len(packed) - np.maximum(n_since, 1), cols]
+                metrics[field] = (last / first_val - 1, n_since >= 2)
+
+        results_df = pd.DataFrame(
+            {field: np.where(available, values, np.nan) for field, (values, available) in metrics.items()},
+            index=close_df.columns,
+        ).reindex(columns=RESULT_COLUMNS)
+        return results_df[counts >= 2]
     except Exception as e:
         print(f"  计算收益率错误: {e}")
-        return None
+        return pd.DataFrame(columns=RESULT_COLUMNS, dtype=float)
 
 def calculate_spread_changes(series):
     """计算利差/比率的变化（绝对值变化，不是百分比）"""
-    if series is None or len(series) < 2:
+    if series is None:
         return None
 
     try:
-        series = series.dropna()
-        current = float(series.iloc[-1])
+        _, values = series
+        values = values[~np.isnan(values)]
+        if len(values) < 2:
+            return None
 
+        current = values[-1]
         result = {"收盘价": safe_float(current)}
 
-        if len(series) >= 2:
-            result["1天"] = safe_float(series.iloc[-1] - series.iloc[-2])
-
-        if len(series) >= 6:
-            result["1星期"] = safe_float(series.iloc[-1] - series.iloc[-6])
-
-        if len(series) >= 22:
-            result["1个月"] = safe_float(series.iloc[-1] - series.iloc[-22])
-
-        if len(series) >= 253:
-            result["1年"] = safe_float(series.iloc[-1] - series.iloc[-253])
-
-        if len(series) >= 756:
-            result["3年"] = safe_float(series.iloc[-1] - series.iloc[-756])
-
-        if len(series) >= 1260:
-            result["5年"] = safe_float(series.iloc[-1] - series.iloc[-1260])
+        for field, lag in RETURN_PERIODS:
+            if len(values) >= lag:
+                result[field] = safe_float(current - values[-lag])
 
         return result
     except Exception as e:
         print(f"  计算变化错误: {e}")
         return None
 
-def fetch_all_data():
-    """获取所有资产数据"""
-    all_data = {}
+def open_price_cache(path=CACHE_DB):
+    """打开本地收盘价缓存 (SQLite)"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS prices("
+        "ticker TEXT, date TEXT, close REAL, PRIMARY KEY(ticker, date))"
+    )
+    return conn
+
+def download_closes_once(tickers, **kwargs):
+    """批量下载一次，返回有数据的 {ticker: 收盘价序列}"""
+    data = yf.download(tickers, progress=False, auto_adjust=True, actions=False,
+                       group_by='ticker', threads=True, **kwargs)
+    if data is None or data.empty:
+        return {}
+
+    # 只保留收盘价，完整的OHLCV表随即释放
+    if isinstance(data.columns, pd.MultiIndex):
+        close_df = data.loc[:, (slice(None), 'Close')].droplevel(1, axis=1)
+    else:
+        close_df = data[['Close']].set_axis(tickers[:1], axis=1)
+    del data
+    closes = {ticker: close_df[ticker].dropna() for ticker in close_df.columns}
+    return {ticker: close for ticker, close in closes.items() if not close.empty}
+
+def download_closes(tickers, retries=3, **kwargs):
+    """批量下载并返回 {ticker: 收盘价序列}
+
+    yf.download 不会因限速 (HTTP 429) 等错误抛出异常，失败的代码只会返回空列
+    或全NaN列，因此按结果判断：只对缺失的代码指数退避重试。
+    """
+    closes = download_closes_once(tickers, **kwargs)
+    for attempt in range(retries):
+        pending = [t for t in tickers if t not in closes]
+        if not pending:
+            break
+        time.sleep(2 ** attempt * 0.5)
+        try:
+            closes.update(download_closes_once(pending, **kwargs))
+        except Exception:
+            pass  # 保留已下载的结果，继续下一次重试
+    return closes
+
+def close_rows(close):
+    """收盘价序列 -> {"YYYY-MM-DD": 收盘价}"""
+    dates = pd.DatetimeIndex(close.index).strftime("%Y-%m-%d")
+    return dict(zip(dates, close.to_numpy(dtype=float).tolist()))
+
+def update_price_cache(conn, tickers, log=print):
+    """只下载缓存中缺失的日期，写入缓存；返回本次下载成功的代码
+
+    auto_adjust=True 的历史价格在拆股/分红后会被整体改写。增量下载从缓存中
+    倒数第二个交易日 (已收盘的最终价) 开始，用这一天校验：价格不一致时
+    清空该代码的缓存并重新下载完整历史。最新一天同时被重新拉取以覆盖盘中数据。
+    """
+    check = {}
+    for ticker in tickers:
+        rows = conn.execute(
+            "SELECT date, close FROM prices WHERE ticker=? ORDER BY date DESC LIMIT 2", (ticker,)
+        ).fetchall()
+        if rows:
+            check[ticker] = rows[-1]
+
+    # 按校验日分组，每组一次批量下载
+    groups = {}
+    for ticker in tickers:
+        groups.setdefault(check[ticker][0] if ticker in check else None, []).append(ticker)
+
+    fetched = {}
+    for start, group in groups.items():
+        try:
+            if start is None:
+                closes = download_closes(group, period="5y")
+            else:
+                closes = download_closes(group, start=start)
+        except Exception as e:
+            log(f"✗ 批量下载失败 ({', '.join(group)}): {e}")
+            continue
+        for ticker, close in closes.items():
+            if not close.empty:
+                fetched[ticker] = close_rows(close)
+
+    readjusted = [
+        ticker for ticker, (date, cached) in check.items()
+        if ticker in fetched and (
+            date not in fetched[ticker]
+            or abs(fetched[ticker][date] - cached) > ADJUST_TOLERANCE * abs(cached)
+        )
+    ]
+    if readjusted:
+        log(f"  复权价格已变化，重新下载完整历史: {', '.join(readjusted)}")
+        try:
+            full = download_closes(readjusted, period="5y")
+        except Exception as e:
+            log(f"✗ 批量下载失败 ({', '.join(readjusted)}): {e}")
+            full = {}
+        for ticker in readjusted:
+            fetched.pop(ticker)
+            if ticker in full and not full[ticker].empty:
+                fetched[ticker] = close_rows(full[ticker])
+
+    rows = [(ticker, date, value) for ticker, closes in fetched.items() for date, value in closes.items()]
+    with conn:
+        conn.executemany("DELETE FROM prices WHERE ticker=?", [(ticker,) for ticker in readjusted])
+        conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?)", rows)
+    return set(fetched)
+
+def load_cached_closes(conn, tickers):
+    """从缓存读取收盘价矩阵 (行: 日期, 列: 代码)"""
+    if not tickers:
+        return None
+    placeholders = ",".join("?" * len(tickers))
+    rows = conn.execute(
+        f"SELECT date, ticker, close FROM prices WHERE ticker IN ({placeholders})", tickers
+    ).fetchall()
+    if not rows:
+        return None
+    df = pd.DataFrame(rows, columns=["date", "ticker", "close"])
+    close_df = df.pivot(index="date", columns="ticker", values="close").sort_index()
+    close_df.index = pd.to_datetime(close_df.index)
+    return close_df
+
+def fetch_yahoo_closes(log=print):
+    """更新缓存并读取所有Yahoo Finance代码的收盘价矩阵"""
+    tickers = [t for t in TICKER_MAP.values() if t]
+    conn = open_price_cache()
+    try:
+        # 本次未能下载的代码不使用旧缓存，避免以新的更新时间发布过期价格
+        updated = update_price_cache(conn, tickers, log=log)
+        return load_cached_closes(conn, [t for t in tickers if t in updated])
+    finally:
+        conn.close()
+
+async def fetch_all_data():
+    """获取所有资产数据 (行: 资产名称, 列: RESULT_COLUMNS)"""
+    # 三个数据源互不依赖，在线程池中同时获取；各自的进度信息先收集，之后按分区输出
+    yahoo_log, fred_log, cboe_log = [], [], []
+    close_df, hy_spread, pc_ratio = await asyncio.gather(
+        asyncio.to_thread(fetch_yahoo_closes, log=yahoo_log.append),
+        asyncio.to_thread(get_fred_data, "BAMLH0A0HYM2", FRED_API_KEY, log=fred_log.append),
+        asyncio.to_thread(get_cboe_put_call_ratio, log=cboe_log.append),
+        return_exceptions=True,
+    )
 
     print("\n--- Yahoo Finance 数据 ---")
+    for line in yahoo_log:
+        print(line)
+    if isinstance(close_df, Exception):
+        raise close_df
+
+    returns_df = calculate_all_returns(close_df)
+    returns_df = returns_df[returns_df["收盘价"].fillna(0) != 0]
+    names = {ticker: name for name, ticker in TICKER_MAP.items() if ticker}
+    results_df = returns_df.rename(index=names)
+    results_df = results_df.reindex([name for name in TICKER_MAP if name in results_df.index])
+
     for name, ticker in TICKER_MAP.items():
         if ticker is None:
             continue
-        try:
-            df = yf.download(ticker, period="5y", progress=False, auto_adjust=True)
-            if df is not None and not df.empty:
-                returns = calculate_returns(df, ticker)
-                if returns and returns.get("收盘价"):
-                    all_data[name] = returns
-                    print(f"✓ {name} ({ticker}): {returns.get('收盘价'):.2f}")
-                else:
-                    print(f"✗ {name} ({ticker}): 无有效数据")
-            else:
-                print(f"✗ {name} ({ticker}): 下载失败")
-        except Exception as e:
-            print(f"✗ {name} ({ticker}): {e}")
-        time.sleep(0.1)
+        if close_df is None or ticker not in close_df.columns:
+            print(f"✗ {name} ({ticker}): 下载失败")
+        elif name in results_df.index:
+            print(f"✓ {name} ({ticker}): {results_df.at[name, '收盘价']:.2f}")
+        else:
+            print(f"✗ {name} ({ticker}): 无有效数据")
 
     print("\n--- FRED 数据 ---")
+    for line in fred_log:
+        print(line)
     try:
-        hy_spread = get_fred_data("BAMLH0A0HYM2", FRED_API_KEY)
-        if hy_spread is not None and len(hy_spread) > 0:
+        if isinstance(hy_spread, Exception):
+            raise hy_spread
+        if hy_spread is not None and len(hy_spread[1]) > 0:
             spread_data = calculate_spread_changes(hy_spread)
             if spread_data:
-                all_data["垃圾债券利差"] = spread_data
+                results_df.loc["垃圾债券利差"] = pd.Series(spread_data, dtype=float)
                 print(f"✓ 垃圾债券利差: {spread_data.get('收盘价'):.2f}%")
             else:
                 print("✗ 垃圾债券利差: 计算失败")
@@ -301,12 +506,15 @@ def fetch_all_data():
         print(f"✗ 垃圾债券利差: {e}")
 
     print("\n--- CBOE 数据 ---")
+    for line in cboe_log:
+        print(line)
     try:
-        pc_ratio = get_cboe_put_call_ratio()
-        if pc_ratio is not None and len(pc_ratio) > 0:
+        if isinstance(pc_ratio, Exception):
+            raise pc_ratio
+        if pc_ratio is not None and len(pc_ratio[1]) > 0:
             pc_data = calculate_spread_changes(pc_ratio)
             if pc_data:
-                all_data["PUT/CALL"] = pc_data
+                results_df.loc["PUT/CALL"] = pd.Series(pc_data, dtype=float)
                 print(f"✓ PUT/CALL Ratio: {pc_data.get('收盘价'):.2f}")
             else:
                 print("✗ PUT/CALL Ratio: 计算失败")
@@ -315,92 +523,187 @@ def fetch_all_data():
     except Exception as e:
         print(f"✗ PUT/CALL Ratio: {e}")
 
-    return all_data
+    return results_df
+
+def iter_asset_metrics(results_df):
+    """逐行输出 (资产名称, {字段: 值})，缺失的周期不包含在内"""
+    columns = results_df.columns
+    values = results_df.to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    # 整表一次完成取整，inf 换成 None (与 safe_float 一致)
+    cleaned = np.where(np.isfinite(values), np.round(values, 6), None).tolist()
+    for name, row, row_present in zip(results_df.index, cleaned, present):
+        yield name, {field: value for field, value, ok in zip(columns, row, row_present) if ok}
+
+def load_json_state(path):
+    """读取本地状态文件，不存在或损坏时返回空字典"""
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def atomic_write(path, content):
+    """原子写入文件 (先写临时文件再重命名)，中途中断不会留下损坏的文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def save_json_state(path, state):
+    """写入本地状态文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write(path, orjson.dumps(state))
 
 def get_notion_pages():
     """获取Notion数据库中的所有页面"""
     url = f"https://api.notion.com/v1/databases/{DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
-    }
-    response = requests.post(url, headers=headers, json={})
+    response = _SESSION.post(url, headers=NOTION_HEADERS, data=orjson.dumps({}))
     if response.status_code == 200:
-        return response.json()["results"]
+        return orjson.loads(response.content)["results"]
     else:
         print(f"获取Notion页面失败: {response.status_code} - {response.text}")
         return []
 
-def update_notion_page(page_id, data):
-    """更新单个Notion页面"""
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
-    }
-
-    properties = {}
-    for field in ["收盘价", "1天", "1星期", "1个月", "1年", "QTD", "YTD"]:
-        if data.get(field) is not None:
-            properties[field] = {"number": data[field]}
-
-    properties["更新时间"] = {"date": {"start": datetime.now().strftime("%Y-%m-%d")}}
-
-    response = requests.patch(url, headers=headers, json={"properties": properties})
-    return response.status_code == 200
+def build_page_mapping(pages):
+    """从查询结果构建 {资产名称: page_id}"""
+    mapping = {}
+    for page in pages:
+        title_prop = page["properties"].get("资产名称", {})
+        if title_prop.get("title") and len(title_prop["title"]) > 0:
+            mapping[title_prop["title"][0]["plain_text"]] = page["id"]
+    return mapping
 
-def update_notion_database(market_data):
+def get_notion_page_mapping(names):
+    """获取 {资产名称: page_id}，缓存未过期且包含所有资产时不再查询数据库"""
+    try:
+        fresh = time.time() - os.path.getmtime(NOTION_PAGES_FILE) < NOTION_PAGES_TTL
+    except OSError:
+        fresh = False
+
+    if fresh:
+        cached = load_json_state(NOTION_PAGES_FILE)
+        known = set(cached.get("pages", {}))
+        # 缺少的资产单独计时：短时间内的重复运行不再查询，之后重新查询以发现新增的行
+        if time.time() - cached.get("missing_checked_at", 0) < NOTION_MISSING_TTL:
+            known |= set(cached.get("missing", []))
+        if all(name in known for name in names):
+            return cached["pages"]
+
+    mapping = build_page_mapping(get_notion_pages())
+    if mapping:
+        missing = sorted(name for name in names if name not in mapping)
+        save_json_state(NOTION_PAGES_FILE, {
+            "pages": mapping,
+            "missing": missing,
+            "missing_checked_at": time.time(),
+        })
+    return mapping
+
+def build_page_properties(data):
+    """构建页面的数值属性"""
+    return {field: {"number": data[field]} for field in NOTION_FIELDS if data.get(field) is not None}
+
+def properties_hash(properties):
+    """属性内容的哈希，用于判断数据是否变化"""
+    return hashlib.sha256(orjson.dumps(properties, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def update_notion_page(session, page_id, properties):
+    """更新单个Notion页面，返回HTTP状态码"""
+    url = f"https://api.notion.com/v1/pages/{page_id}"
+    properties = dict(properties)
+    properties["更新时间"] = TODAY_DATE_PROP
+
+    payload = orjson.dumps({"properties": properties})
+    async with session.patch(url, headers=NOTION_HEADERS, data=payload) as response:
+        return response.status
+
+async def _patch(session, semaphore, limiter, name, page_id, properties):
+    """在并发与速率限制下更新页面"""
+    async with semaphore:
+        async with limiter:
+            try:
+                status = await update_notion_page(session, page_id, properties)
+            except Exception as e:
+                print(f"  更新错误 ({name}): {e}")
+                status = None
+    if status == 404:
+        # 页面已被删除，映射缓存失效，下次运行重新查询数据库
+        try:
+            os.remove(NOTION_PAGES_FILE)
+        except OSError:
+            pass
+    success = status == 200
+    print(f"{'✓' if success else '✗'} 更新 {name}")
+    return success
+
+async def update_notion_database(results_df):
     """更新整个Notion数据库"""
     if not NOTION_API_KEY:
         print("跳过Notion更新 (无API Key)")
         return
 
-    pages = get_notion_pages()
-    if not pages:
+    market_data = dict(iter_asset_metrics(results_df))
+    mapping = get_notion_page_mapping(list(market_data))
+    if not mapping:
         print("警告: 未获取到Notion页面")
         return
 
     print("\n--- 更新Notion ---")
-    for page in pages:
-        title_prop = page["properties"].get("资产名称", {})
-        if title_prop.get("title") and len(title_prop["title"]) > 0:
-            name = title_prop["title"][0]["plain_text"]
-            if name in market_data:
-                success = update_notion_page(page["id"], market_data[name])
-                print(f"{'✓' if success else '✗'} 更新 {name}")
-                time.sleep(0.35)
-
-def save_json_data(market_data):
+    matching_pages = [(name, page_id) for name, page_id in mapping.items() if name in market_data]
+
+    # 数值与上次写入完全相同的页面不再PATCH
+    last_written = load_json_state(LAST_WRITTEN_FILE)
+    pending = []
+    for name, page_id in matching_pages:
+        properties = build_page_properties(market_data[name])
+        digest = properties_hash(properties)
+        if last_written.get(page_id) == digest:
+            print(f"- 跳过 {name} (数据未变化)")
+            continue
+        pending.append((name, page_id, properties, digest))
+
+    semaphore = asyncio.Semaphore(NOTION_CONCURRENCY)
+    limiter = AsyncLimiter(NOTION_CONCURRENCY, 1)
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(*[
+            _patch(session, semaphore, limiter, name, page_id, properties)
+            for name, page_id, properties, _ in pending
+        ])
+
+    for (_, page_id, _, digest), success in zip(pending, results):
+        if success:
+            last_written[page_id] = digest
+    save_json_state(LAST_WRITTEN_FILE, last_written)
+
+def save_json_data(results_df):
     """保存数据为JSON文件"""
     output = {
         "updateTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "assets": market_data
+        "assets": dict(iter_asset_metrics(results_df))
     }
-    with open("data.json", "w", encoding="utf-8") as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
+    atomic_write("data.json", orjson.dumps(output, option=orjson.OPT_INDENT_2))
     print("✓ 已保存 data.json")
 
-def main():
+async def main_async():
     print("=" * 50)
     print("市场数据矩阵更新器 v6")
     print(f"运行时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 50)
 
     print("\n[1/3] 获取市场数据...")
-    market_data = fetch_all_data()
-    print(f"\n成功获取 {len(market_data)} 个资产数据")
+    results_df = await fetch_all_data()
+    print(f"\n成功获取 {len(results_df)} 个资产数据")
 
     print("\n[2/3] 保存JSON数据文件...")
-    save_json_data(market_data)
+    save_json_data(results_df)
 
     print("\n[3/3] 更新Notion数据库...")
-    update_notion_database(market_data)
+    await update_notion_database(results_df)
 
     print("\n" + "=" * 50)
     print("更新完成!")
     print("=" * 50)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main_async())
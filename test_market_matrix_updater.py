@@ -0,0 +1,230 @@
+"""
+market_matrix_updater 的离线测试：收益率矩阵、收盘价缓存、Notion页面映射缓存
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import market_matrix_updater as mmu
+
+
+def reference_returns(close):
+    """逐个代码、基于pandas的原始算法"""
+    close = close.dropna()
+    if len(close) < 2:
+        return None
+
+    returns = {"收盘价": close.iloc[-1]}
+    for field, lag in mmu.RETURN_PERIODS:
+        if len(close) >= lag:
+            returns[field] = close.iloc[-1] / close.iloc[-lag] - 1
+
+    today = close.index[-1]
+    quarter_month = ((today.month - 1) // 3) * 3 + 1
+    qtd_data = close[close.index >= pd.Timestamp(today.year, quarter_month, 1)]
+    if len(qtd_data) >= 2:
+        returns["QTD"] = qtd_data.iloc[-1] / qtd_data.iloc[0] - 1
+
+    ytd_data = close[close.index >= pd.Timestamp(today.year, 1, 1)]
+    if len(ytd_data) >= 2:
+        returns["YTD"] = ytd_data.iloc[-1] / ytd_data.iloc[0] - 1
+
+    return returns
+
+
+def assert_matches_reference(close_df):
+    results_df = mmu.calculate_all_returns(close_df)
+    for ticker in close_df.columns:
+        expected = reference_returns(close_df[ticker])
+        if expected is None:
+            assert ticker not in results_df.index
+            continue
+        actual = results_df.loc[ticker].dropna().to_dict()
+        assert actual == pytest.approx(expected, rel=1e-12), ticker
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_random_frames_with_gaps(seed):
+    rng = np.random.default_rng(seed)
+    n_rows = int(rng.integers(1, 1400))
+    index = pd.date_range("2021-06-01", periods=n_rows, freq="D")
+    values = rng.uniform(1, 2, (n_rows, 6))
+    values[rng.random((n_rows, 6)) < rng.uniform(0, 0.9)] = np.nan
+    close_df = pd.DataFrame(values, index=index, columns=list("ABCDEF"))
+    assert_matches_reference(close_df)
+
+
+def test_each_ticker_uses_its_own_last_date():
+    # BTC 跨年，股票仍停在上一年最后一个交易日
+    stock = pd.Series(np.linspace(100, 120, 320), index=pd.bdate_range("2025-10-01", periods=320))
+    stock = stock[stock.index <= "2026-12-31"]
+    btc_index = pd.date_range("2025-10-01", "2027-01-02", freq="D")
+    btc = pd.Series(np.linspace(50, 80, len(btc_index)), index=btc_index)
+    close_df = pd.DataFrame({"SPY": stock, "BTC-USD": btc})
+    assert_matches_reference(close_df)
+
+
+def test_tickers_without_enough_data_are_dropped():
+    index = pd.bdate_range("2026-01-01", periods=5)
+    close_df = pd.DataFrame({
+        "A": [1.0, 2.0, 3.0, 4.0, 5.0],
+        "B": [np.nan, np.nan, np.nan, np.nan, 7.0],
+        "C": [np.nan] * 5,
+    }, index=index)
+    results_df = mmu.calculate_all_returns(close_df)
+    assert list(results_df.index) == ["A"]
+    assert_matches_reference(close_df)
+
+
+class FakeNotion:
+    """记录查询次数的 get_notion_pages 替身"""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.queries = 0
+
+    def __call__(self):
+        self.queries += 1
+        return [
+            {"id": f"page-{name}", "properties": {"资产名称": {"title": [{"plain_text": name}]}}}
+            for name in self.names
+        ]
+
+
+@pytest.fixture
+def notion(tmp_path, monkeypatch):
+    fake = FakeNotion(["A", "B"])
+    clock = [time.time()]
+    monkeypatch.setattr(mmu, "NOTION_PAGES_FILE", str(tmp_path / ".cache" / "notion_pages.json"))
+    monkeypatch.setattr(mmu, "get_notion_pages", fake)
+    monkeypatch.setattr(mmu.time, "time", lambda: clock[0])
+    fake.clock = clock
+    return fake
+
+
+def test_page_mapping_fresh_cache_hit(notion):
+    assert mmu.get_notion_page_mapping(["A", "B"]) == {"A": "page-A", "B": "page-B"}
+    assert mmu.get_notion_page_mapping(["A", "B"]) == {"A": "page-A", "B": "page-B"}
+    assert notion.queries == 1
+
+    notion.clock[0] += mmu.NOTION_PAGES_TTL + 1
+    mmu.get_notion_page_mapping(["A", "B"])
+    assert notion.queries == 2
+
+
+def test_page_mapping_missing_name_requeried_after_ttl(notion):
+    mmu.get_notion_page_mapping(["A", "C"])
+    mmu.get_notion_page_mapping(["A", "C"])
+    assert notion.queries == 1
+
+    notion.clock[0] += mmu.NOTION_MISSING_TTL + 1
+    mmu.get_notion_page_mapping(["A", "C"])
+    assert notion.queries == 2
+
+
+def test_page_mapping_picks_up_row_added_later(notion):
+    assert "C" not in mmu.get_notion_page_mapping(["A", "C"])
+
+    notion.names.append("C")
+    notion.clock[0] += mmu.NOTION_MISSING_TTL + 1
+    assert mmu.get_notion_page_mapping(["A", "C"])["C"] == "page-C"
+    assert mmu.get_notion_page_mapping(["A", "C"])["C"] == "page-C"
+    assert notion.queries == 2
+
+
+class FakeYahoo:
+    """按截止日返回历史收盘价的 yf.download 替身，记录每次调用"""
+
+    def __init__(self, tickers):
+        index = pd.bdate_range("2021-01-04", "2026-10-30")
+        rng = np.random.default_rng(0)
+        self.history = {
+            ticker: pd.Series(100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(index)))), index=index)
+            for ticker in tickers
+        }
+        self.today = pd.Timestamp("2026-10-14")
+        self.empty = set()
+        self.calls = []
+
+    def __call__(self, tickers, start=None, period=None, **kwargs):
+        self.calls.append((list(tickers), start, period))
+        frames = {}
+        for ticker in tickers:
+            close = self.history[ticker][:self.today]
+            if start is not None:
+                close = close[pd.Timestamp(start):]
+            elif period == "5y":
+                close = close[self.today - pd.DateOffset(years=5):]
+            if ticker in self.empty:
+                close = close * np.nan
+            frames[ticker] = pd.DataFrame({"Open": close, "Close": close})
+        return pd.concat(frames, axis=1)
+
+
+@pytest.fixture
+def yahoo(tmp_path, monkeypatch):
+    fake = FakeYahoo(["SPY", "QQQ"])
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mmu.yf, "download", fake)
+    monkeypatch.setattr(mmu.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(mmu, "TICKER_MAP", {"标普500": "SPY", "纳指": "QQQ"})
+    fake.conn = mmu.open_price_cache()  # 与 fetch_yahoo_closes 共用临时目录中的 CACHE_DB
+    yield fake
+    fake.conn.close()
+
+
+def cached_closes(conn, ticker):
+    rows = conn.execute("SELECT date, close FROM prices WHERE ticker=? ORDER BY date", (ticker,)).fetchall()
+    return dict(rows)
+
+
+def test_price_cache_first_run_downloads_5y(yahoo):
+    updated = mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    assert updated == {"SPY", "QQQ"}
+    assert yahoo.calls == [(["SPY", "QQQ"], None, "5y")]
+    assert max(cached_closes(yahoo.conn, "SPY")) == "2026-10-14"
+
+
+def test_price_cache_next_day_fetches_from_second_latest_date(yahoo):
+    mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    yahoo.today = pd.Timestamp("2026-10-15")
+    yahoo.calls.clear()
+
+    mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    assert yahoo.calls == [(["SPY", "QQQ"], "2026-10-13", None)]
+    cached = cached_closes(yahoo.conn, "SPY")
+    assert cached["2026-10-15"] == pytest.approx(yahoo.history["SPY"]["2026-10-15"])
+
+
+def test_price_cache_reloads_history_after_adjustment(yahoo):
+    mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    # 4:1 拆股：Yahoo 改写拆股日之前的全部复权价
+    yahoo.history["SPY"][:"2026-10-14"] /= 4
+    yahoo.today = pd.Timestamp("2026-10-15")
+    yahoo.calls.clear()
+
+    mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    assert (["SPY"], None, "5y") in yahoo.calls
+    cached = cached_closes(yahoo.conn, "SPY")
+    expected = yahoo.history["SPY"][yahoo.today - pd.DateOffset(years=5):yahoo.today]
+    assert list(cached) == list(expected.index.strftime("%Y-%m-%d"))
+    assert list(cached.values()) == pytest.approx(expected.tolist())
+    # 未复权的代码不受影响
+    assert (["QQQ"], None, "5y") not in yahoo.calls
+
+
+def test_price_cache_empty_download_is_not_published(yahoo):
+    mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    yahoo.today = pd.Timestamp("2026-10-15")
+    yahoo.empty.add("QQQ")
+
+    updated = mmu.update_price_cache(yahoo.conn, ["SPY", "QQQ"], log=lambda line: None)
+    assert updated == {"SPY"}
+    assert cached_closes(yahoo.conn, "QQQ")
+
+    # 缓存中仍有 QQQ 的旧数据，但本次下载失败，不应被读取发布
+    close_df = mmu.fetch_yahoo_closes(log=lambda line: None)
+    assert list(close_df.columns) == ["SPY"]